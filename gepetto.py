@@ -1,24 +1,31 @@
+import asyncio
+import collections
 import functools
+import hashlib
+import io
 import json
 import os
 import re
+import sqlite3
+import string
 import textwrap
 import threading
+import time
 import traceback
+import uuid
 import gettext
 
 import idaapi
 import ida_hexrays
 import ida_kernwin
 import idc
-import openai
 
 # =============================================================================
 # EDIT VARIABLES IN THIS SECTION
 # =============================================================================
 
 # Set your API key here, or put it in the OPENAI_API_KEY environment variable.
-openai.api_key = ""
+api_key = ""
 
 # Specify the program language. It can be "fr_FR", "zh_CN", or any folder in gepetto-locales.
 # Defaults to English.
@@ -27,6 +34,18 @@ language = ""
 # Determines whether the program should print output in a more verbose manner.
 debug = False
 
+# When enabled, queries are queued instead of being sent immediately, and submitted
+# together through OpenAI's Batch API ("Edit/Gepetto/Flush batch"). Batched queries
+# cost half as much and bypass the per-minute rate limits, but may take up to 24
+# hours to complete.
+batch_mode = False
+
+# Maximum number of in-flight queries when Gepetto is scripted over many functions.
+max_parallel_requests = 4
+
+# Requests-per-minute budget, used to stay under the API rate limits.
+max_requests_per_minute = 60
+
 # =============================================================================
 # END
 # =============================================================================
@@ -38,6 +57,40 @@ translate = gettext.translation('gepetto',
                                 languages=[language])
 _ = translate.gettext
 
+# Patterns used by the response parsing paths, compiled once at load time.
+_GEPETTO_HEADER = _("Comment generated by Gepetto")
+_GEPETTO_CMT_RE = re.compile(r'----- ' + re.escape(_GEPETTO_HEADER) +
+                             r' -----.*?----------------------------------------', re.DOTALL)
+_FMT_RE = re.compile(r'\{[0-9A-Za-z_]*\}')
+_JSON_DECODER = json.JSONDecoder()
+_COMMENT_WRAPPER = textwrap.TextWrapper(width=80, replace_whitespace=False)
+_COMMENT_FORMATTER = string.Formatter()
+_WS_RUN_RE = re.compile(r'[ \t]+')
+_BLANK_LINES_RE = re.compile(r'\n{2,}')
+_CALLCONV_RE = re.compile(r'\b(__fastcall|__cdecl|__stdcall|__thiscall|__usercall|__noreturn)\b ?')
+
+# The OpenAI SDK drags in its whole HTTP stack, a multi-hundred-millisecond
+# import that would otherwise be paid on every IDA startup. It is only loaded
+# when the first query is actually made.
+@functools.lru_cache(maxsize=1)
+def _load_openai():
+    import openai
+    import requests
+    openai.api_key = api_key
+    # Shared pooled session for the synchronous Batch API calls, so they reuse
+    # warm connections instead of paying a TLS handshake each time.
+    openai.requestssession = requests.Session()
+    return openai
+
+# orjson is optional; when present, its C parser speeds up decoding large responses.
+@functools.lru_cache(maxsize=1)
+def _load_orjson():
+    try:
+        import orjson
+        return orjson
+    except ImportError:
+        return None
+
 # =============================================================================
 # Setup the context menu and hotkey in IDA
 # =============================================================================
@@ -50,6 +103,10 @@ class GepettoPlugin(idaapi.plugin_t):
     comments_menu_path = "Edit/Gepetto/" + _("Auto-complete comments")
     rename_action_name = "gepetto:rename_function"
     rename_menu_path = "Edit/Gepetto/" + _("Rename variables")
+    flush_batch_action_name = "gepetto:flush_batch"
+    flush_batch_menu_path = "Edit/Gepetto/" + _("Flush batch")
+    clear_cache_action_name = "gepetto:clear_cache"
+    clear_cache_menu_path = "Edit/Gepetto/" + _("Clear Gepetto cache")
     wanted_name = 'Gepetto'
     wanted_hotkey = ''
     comment = _("Uses gpt-3.5-turbo to enrich the decompiler's output")
@@ -91,6 +148,26 @@ class GepettoPlugin(idaapi.plugin_t):
         idaapi.register_action(rename_action)
         idaapi.attach_action_to_menu(self.rename_menu_path, self.rename_action_name, idaapi.SETMENU_APP)
 
+        # Batch submission action
+        flush_batch_action = idaapi.action_desc_t(self.flush_batch_action_name,
+                                                  _('Flush batch'),
+                                                  FlushBatchHandler(),
+                                                  "",
+                                                  _('Submit all the queued queries through the Batch API'),
+                                                  199)
+        idaapi.register_action(flush_batch_action)
+        idaapi.attach_action_to_menu(self.flush_batch_menu_path, self.flush_batch_action_name, idaapi.SETMENU_APP)
+
+        # Cache clearing action
+        clear_cache_action = idaapi.action_desc_t(self.clear_cache_action_name,
+                                                  _('Clear Gepetto cache'),
+                                                  ClearCacheHandler(),
+                                                  "",
+                                                  _('Forget all the cached model responses'),
+                                                  199)
+        idaapi.register_action(clear_cache_action)
+        idaapi.attach_action_to_menu(self.clear_cache_menu_path, self.clear_cache_action_name, idaapi.SETMENU_APP)
+
         # Register context menu actions
         self.menu = ContextMenuHooks()
         self.menu.hook()
@@ -104,6 +181,8 @@ class GepettoPlugin(idaapi.plugin_t):
         idaapi.detach_action_from_menu(self.explain_menu_path, self.explain_action_name)
         idaapi.detach_action_from_menu(self.comments_menu_path, self.comments_action_name)
         idaapi.detach_action_from_menu(self.rename_menu_path, self.rename_action_name)
+        idaapi.detach_action_from_menu(self.flush_batch_menu_path, self.flush_batch_action_name)
+        idaapi.detach_action_from_menu(self.clear_cache_menu_path, self.clear_cache_action_name)
         if self.menu:
             self.menu.unhook()
         return
@@ -120,6 +199,32 @@ class ContextMenuHooks(idaapi.UI_Hooks):
 
 # -----------------------------------------------------------------------------
 
+# ida_hexrays.decompile runs the full Hex-Rays pass, which costs hundreds of
+# milliseconds on large functions. The handlers share its output through this
+# per-function cache; entries are invalidated when the function's boundaries
+# or flags change.
+_decomp_cache = {}
+
+def get_decompilation(ea):
+    """
+    Returns the decompiler output for the function at the given address, along with
+    its rendered pseudocode. The results are memoized until the function changes.
+    :param ea: An address belonging to the function to decompile
+    """
+    func = idaapi.get_func(ea)
+    if func:
+        token = (func.end_ea, func.flags)
+        hit = _decomp_cache.get(func.start_ea)
+        if hit and hit[0] == token:
+            return hit[1], hit[2]
+    decompiler_output = ida_hexrays.decompile(ea)
+    text = str(decompiler_output)
+    if func:
+        _decomp_cache[func.start_ea] = (token, decompiler_output, text)
+    return decompiler_output, text
+
+# -----------------------------------------------------------------------------
+
 def inline_comments_callback(address, view, decompiled_func, response, retries=0):
     """
     Callback that sets the inline comments at the requested places.
@@ -136,23 +241,32 @@ def inline_comments_callback(address, view, decompiled_func, response, retries=0
     if not kwargs:
         return
 
-    # Numeric format string arguments are supplied as positional arguments
-    make_args = lambda kwargs: [kwargs.get(str(i)) for i in range(max(map(int, filter(str.isdigit, kwargs.keys()))) + 1)]
-    args = make_args(kwargs)
+    # Numeric format string arguments are supplied as positional arguments.
+    # Keys the model left out resolve to an empty string through the
+    # defaultdict, so formatting a comment no longer raises on missing keys.
+    numeric = [int(k) for k in kwargs if k.isdigit()]
+    args = [""] * (max(numeric, default=-1) + 1)
+    for i in numeric:
+        args[i] = kwargs[str(i)] or ""
+    fields = collections.defaultdict(str, kwargs)
 
-    for key in decompiled_func.user_cmts:
+    for key, cmt in decompiled_func.user_cmts.items():
         try:
-            cmt = decompiled_func.user_cmts[key].c_str()
-            decompiled_func.set_user_cmt(key, cmt.format(*args, **kwargs))
+            decompiled_func.set_user_cmt(key, _COMMENT_FORMATTER.vformat(cmt.c_str(), args, fields))
         except:
             if debug:
                 traceback.print_exc()
 
     decompiled_func.save_user_cmts()
 
-    # Refresh the window so the comment is displayed properly
-    if view:
-        view.refresh_view(False)
+    # The comments changed; drop the cached decompilation of this function.
+    func = idaapi.get_func(address)
+    if func:
+        _decomp_cache.pop(func.start_ea, None)
+
+    # Refresh the window so the comments are displayed properly; request_refresh
+    # coalesces the redraws when several responses land close together.
+    ida_kernwin.request_refresh(ida_kernwin.IWID_PSEUDOCODE)
     print("davinci-003 query finished!")
 
 # -----------------------------------------------------------------------------
@@ -165,10 +279,16 @@ def extract_decompilation(decompilation, window=320):
     :param window: The amount of additional context to give, before the first comment
         and after the last one.
     '''
-    start_match = re.search(r'(\{[0-9A-Za-z_]*\})', decompilation)
-    end_match = re.search(r'(\}[0-9A-Za-z_]*\{)', decompilation[::-1])
-    start = start_match.start() if start_match is not None else 0
-    end = len(decompilation) - (end_match.end() if end_match is not None else 0)
+    # A single forward scan yields both the first and the last format string,
+    # keeping only the current boundaries instead of materializing every
+    # intermediate match object.
+    start = end = None
+    for match in _FMT_RE.finditer(decompilation):
+        if start is None:
+            start = match.start()
+        end = match.start()
+    if start is None:
+        return decompilation
 
     if start > 0:
         text = decompilation
@@ -188,29 +308,44 @@ def extract_decompilation(decompilation, window=320):
 
 # -----------------------------------------------------------------------------
 
+def compact_decompilation(decompilation):
+    '''
+    Strips the parts of the decompilation that carry no meaning for the model
+    (indentation, repeated blank lines, calling conventions) so each query
+    uploads fewer tokens.
+    :param decompilation: The decompilation generated by hex-rays
+    '''
+    decompilation = _CALLCONV_RE.sub('', decompilation)
+    decompilation = _WS_RUN_RE.sub(' ', decompilation)
+    return _BLANK_LINES_RE.sub('\n', decompilation)
+
+# -----------------------------------------------------------------------------
+
 class ExplainFurtherHandler(idaapi.action_handler_t):
     """
     This handler is tasked with querying gpt-3.5-turbo for an explanation of the
     given function at specific places, by auto-completing the format string specifiers
     in the comments.
     """
+    # The prompt never changes between activations, so it is built once here.
+    query_prompt = "Analyze the following C function. Treat the comments as python format string (formatted with curly braces), and " \
+                   "complete the comments. Reply with a single JSON where the keys are the values in the curly braces (without the braces), " \
+                   "and the values are the matching substituted strings.\n" \
+                   "The completions should make up valuable comments. Print only the json, without any other explanation.\n\n"
+
     def __init__(self):
         idaapi.action_handler_t.__init__(self)
 
     def activate(self, ctx):
-        decompiler_output = ida_hexrays.decompile(idaapi.get_screen_ea())
+        ea = idaapi.get_screen_ea()
+        decompiler_output, text = get_decompilation(ea)
         v = ida_hexrays.get_widget_vdui(ctx.widget)
-        query_model_async("Analyze the following C function. Treat the comments as python format string (formatted with curly braces), and " + \
-                          "complete the comments. Reply with a single JSON where the keys are the values in the curly braces (without the braces), " + \
-                          "and the values are the matching substituted strings.\n" + \
-                          "The completions should make up valuable comments. Print only the json, without any other explanation.\n\n" \
-                          + extract_decompilation(str(decompiler_output)),
-                          functools.partial(inline_comments_callback,
-                            address=idaapi.get_screen_ea(),
-                            view=v,
-                            decompiled_func=decompiler_output))
+        shrunk = compact_decompilation(extract_decompilation(text))
+        query_model_async(self.query_prompt + shrunk,
+                          lambda response, address=ea, view=v, decompiled_func=decompiler_output:
+                              inline_comments_callback(address, view, decompiled_func, response))
         if debug:
-            print(extract_decompilation(str(decompiler_output)))
+            print(shrunk)
         return 1
 
     # This action is always available.
@@ -219,31 +354,29 @@ class ExplainFurtherHandler(idaapi.action_handler_t):
 
 # -----------------------------------------------------------------------------
 
-def comment_callback(address, view, response):
+def comment_callback(address, view, response, final=True):
     """
     Callback that sets a comment at the given address.
     :param address: The address of the function to comment
     :param view: A handle to the decompiler window
     :param response: The comment to add
+    :param final: Whether the response is complete, or a partial streaming update
     """
-    response = "\n".join(textwrap.wrap(response, 80, replace_whitespace=False))
+    response = _COMMENT_WRAPPER.fill(response)
 
     # Add the response as a comment in IDA, but preserve any existing non-Gepetto comment
     comment = idc.get_func_cmt(address, 0)
-    comment = re.sub(r'----- ' + _("Comment generated by Gepetto") + ' -----.*?----------------------------------------',
-                     r"",
-                     comment,
-                     flags=re.DOTALL)
+    comment = _GEPETTO_CMT_RE.sub(r"", comment)
 
-    idc.set_func_cmt(address, '----- ' + _("Comment generated by Gepetto") +
+    idc.set_func_cmt(address, '----- ' + _GEPETTO_HEADER +
                      f" -----\n\n"
                      f"{response.strip()}\n\n"
                      f"----------------------------------------\n\n"
                      f"{comment.strip()}", 0)
     # Refresh the window so the comment is displayed properly
-    if view:
-        view.refresh_view(False)
-    print(_("gpt-3.5-turbo query finished!"))
+    ida_kernwin.request_refresh(ida_kernwin.IWID_PSEUDOCODE)
+    if final:
+        print(_("gpt-3.5-turbo query finished!"))
 
 
 # -----------------------------------------------------------------------------
@@ -254,15 +387,21 @@ class ExplainHandler(idaapi.action_handler_t):
     given function. Once the reply is received, it is added as a function
     comment.
     """
+    # Localized once at class creation; only the decompilation changes per call.
+    query_template = _("Can you explain what the following C function does and suggest a better name for it?\n"
+                       "{decompiler_output}")
+
     def __init__(self):
         idaapi.action_handler_t.__init__(self)
 
     def activate(self, ctx):
-        decompiler_output = ida_hexrays.decompile(idaapi.get_screen_ea())
+        ea = idaapi.get_screen_ea()
+        decompiler_output, text = get_decompilation(ea)
         v = ida_hexrays.get_widget_vdui(ctx.widget)
-        query_model_async(_("Can you explain what the following C function does and suggest a better name for it?\n"
-                            "{decompiler_output}").format(decompiler_output=str(decompiler_output)),
-                          functools.partial(comment_callback, address=idaapi.get_screen_ea(), view=v))
+        query_model_async(self.query_template.format(decompiler_output=compact_decompilation(text)),
+                          lambda response, final=True, address=ea, view=v:
+                              comment_callback(address, view, response, final),
+                          stream=True)
         return 1
 
     # This action is always available.
@@ -280,28 +419,46 @@ def rename_callback(address, view, response, retries=0):
     :param response: The response from gpt-3.5-turbo
     :param retries: The number of times that we received invalid JSON
     """
-    names = extract_json_or_retry(response, retries, rename_callback, address=idaapi.get_screen_ea(), view=view)
+    names = extract_json_or_retry(response, retries, rename_callback, address=address, view=view)
     if not names:
         return
 
     # The rename function needs the start address of the function
     function_addr = idaapi.get_func(address).start_ea
 
+    # Names that don't exist in the function are skipped up front, so
+    # rename_lvar doesn't rescan the whole lvar list for each hallucinated key.
+    # The view may have navigated elsewhere while the query was in flight, so
+    # its lvars are only trusted if it still shows the target function.
+    existing = None
+    if view and view.cfunc.entry_ea == function_addr:
+        existing = {lvar.name for lvar in view.cfunc.get_lvars()}
+
     replaced = []
-    for n in names:
-        if ida_hexrays.rename_lvar(function_addr, n, names[n]):
+    for n, new_name in names.items():
+        if existing is not None and n not in existing:
+            continue
+        if ida_hexrays.rename_lvar(function_addr, n, new_name):
             replaced.append(n)
 
-    # Update possible names left in the function comment
+    # Update possible names left in the function comment, in a single pass
+    # over the comment instead of one per renamed variable.
     comment = idc.get_func_cmt(address, 0)
     if comment and len(replaced) > 0:
-        for n in replaced:
-            comment = re.sub(r'\b%s\b' % n, names[n], comment)
+        pattern = re.compile(r'\b(' + '|'.join(re.escape(n) for n in replaced) + r')\b')
+        comment = pattern.sub(lambda m: names[m.group(1)], comment)
         idc.set_func_cmt(address, comment, 0)
 
-    # Refresh the window to show the new names
+    # The pseudocode changed; drop the cached decompilation of this function.
+    _decomp_cache.pop(function_addr, None)
+
+    # Refresh the window to show the new names. Unlike the comment callbacks,
+    # a repaint is not enough here: the displayed cfunc still carries the old
+    # lvar names, so the view must be forced to re-decompile.
     if view:
         view.refresh_view(True)
+    else:
+        ida_kernwin.request_refresh(ida_kernwin.IWID_PSEUDOCODE)
     print(_("gpt-3.5-turbo query finished! {replaced} variable(s) renamed.").format(replaced=len(replaced)))
 
 # -----------------------------------------------------------------------------
@@ -315,8 +472,12 @@ def extract_json_or_retry(response, retries, retry_callback, **retry_kwargs):
     :param retry_callback: The function to call after fixing the json if it is invalid.
     :retry_kwargs: The arguments to pass into the callback.
     '''
-    j = re.search(r"\{[^}]*?\}", response)
-    if not j:
+    # Decode in place from the first brace or bracket: raw_decode handles
+    # nested documents and trailing prose, neither of which should cost us a
+    # model round trip. Prose may contain incidental brackets, so each anchor
+    # is tried in order until one yields usable data.
+    starts = sorted(i for i in (response.find('{'), response.find('[')) if i >= 0)
+    if not starts:
         if retries >= 3:  # Give up obtaining the JSON after 3 times.
             print(_("Could not obtain valid data from the model, giving up. Dumping the response for manual import:"))
             print(response)
@@ -324,18 +485,46 @@ def extract_json_or_retry(response, retries, retry_callback, **retry_kwargs):
         print(_("Cannot extract valid JSON from the response. Asking the model to fix it..."))
         query_model_async(_("The JSON document provided in this response is invalid. Can you fix it?\n"
                             "{response}").format(response=response),
-                          functools.partial(retry_callback, **retry_kwargs, retries=retries + 1))
+                          functools.partial(retry_callback, **retry_kwargs, retries=retries + 1),
+                          delay=2 ** retries * 0.5)
         return None
-    try:
-        data = json.loads(j.group(0))
-    except json.decoder.JSONDecodeError:
+    orjson = _load_orjson()
+    data = None
+    for start in starts:
+        candidate = None
+        if orjson is not None:
+            # Fast path: most responses are a bare JSON document, which orjson
+            # parses in C. Responses with trailing prose fall through to
+            # raw_decode below, which tolerates them.
+            try:
+                candidate = orjson.loads(response[start:])
+            except orjson.JSONDecodeError:
+                pass
+        if candidate is None:
+            try:
+                candidate, _end = _JSON_DECODER.raw_decode(response, start)
+            except json.decoder.JSONDecodeError:
+                continue
+        if isinstance(candidate, list):
+            # Array-wrapped responses are flattened into a single mapping, as
+            # the callbacks expect a dictionary.
+            merged = {}
+            for element in candidate:
+                if isinstance(element, dict):
+                    merged.update(element)
+            candidate = merged
+        data = candidate
+        if data:
+            break
+    if data is None:
         if retries >= 3:  # Give up fixing the JSON after 3 times.
             print(_("Could not obtain valid data from the model, giving up. Dumping the response for manual import:"))
             print(response)
             return
         print(_("The JSON document returned is invalid. Asking the model to fix it..."))
-        query_model_async(_("Please fix the following JSON document:\n{json}").format(json=j.group(0)),
-                          functools.partial(retry_callback, **retry_kwargs, retries=retries + 1))
+        query_model_async(_("Please fix the following JSON document:\n{json}").format(json=response[starts[0]:]),
+                          functools.partial(retry_callback, **retry_kwargs, retries=retries + 1),
+                          delay=2 ** retries * 0.5)
         return None
     return data
 
@@ -347,17 +536,232 @@ class RenameHandler(idaapi.action_handler_t):
     This handler requests new variable names from gpt-3.5-turbo and updates the
     decompiler's output.
     """
+    # Localized once at class creation; only the decompilation changes per call.
+    query_template = _("Analyze the following C function:\n{decompiler_output}"
+                       "\nSuggest better variable names, reply with a JSON array where keys are the original names "
+                       "and values are the proposed names. Do not explain anything, only print the JSON "
+                       "dictionary.")
+
     def __init__(self):
         idaapi.action_handler_t.__init__(self)
 
     def activate(self, ctx):
-        decompiler_output = ida_hexrays.decompile(idaapi.get_screen_ea())
+        ea = idaapi.get_screen_ea()
+        decompiler_output, text = get_decompilation(ea)
         v = ida_hexrays.get_widget_vdui(ctx.widget)
-        query_model_async(_("Analyze the following C function:\n{decompiler_output}"
-                            "\nSuggest better variable names, reply with a JSON array where keys are the original names "
-                            "and values are the proposed names. Do not explain anything, only print the JSON "
-                            "dictionary.").format(decompiler_output=str(decompiler_output)),
-                          functools.partial(rename_callback, address=idaapi.get_screen_ea(), view=v))
+        query_model_async(self.query_template.format(decompiler_output=compact_decompilation(text)),
+                          lambda response, address=ea, view=v:
+                              rename_callback(address, view, response))
+        return 1
+
+    # This action is always available.
+    def update(self, ctx):
+        return idaapi.AST_ENABLE_ALWAYS
+
+# =============================================================================
+# Response cache
+# =============================================================================
+
+# Responses are memoized on (model, query) so re-running Explain/Rename on an
+# unchanged function returns instantly instead of paying another round trip.
+# A small in-process dictionary fronts a SQLite database persisted in the user
+# directory, which survives across IDA sessions.
+_cache_db = None
+_cache_lock = threading.Lock()
+_mem_cache = {}
+_MEM_CACHE_SIZE = 256
+
+def _cache_key(model, query):
+    return hashlib.blake2b("{}\0{}".format(model, query).encode("utf-8"), digest_size=16).digest()
+
+def _open_cache():
+    global _cache_db
+    if _cache_db is None:
+        path = os.path.join(idaapi.get_user_idadir(), "gepetto_cache.sqlite")
+        _cache_db = sqlite3.connect(path, check_same_thread=False)
+        _cache_db.execute("CREATE TABLE IF NOT EXISTS responses (key BLOB PRIMARY KEY, response TEXT, ts INTEGER)")
+        _cache_db.commit()
+    return _cache_db
+
+def _cache_get(model, query):
+    """
+    Returns the cached response for the given query, or None if it was never
+    answered before.
+    """
+    key = _cache_key(model, query)
+    with _cache_lock:
+        if key in _mem_cache:
+            return _mem_cache[key]
+        row = _open_cache().execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def _cache_put(model, query, response):
+    key = _cache_key(model, query)
+    with _cache_lock:
+        if len(_mem_cache) >= _MEM_CACHE_SIZE:
+            _mem_cache.pop(next(iter(_mem_cache)))
+        _mem_cache[key] = response
+        db = _open_cache()
+        db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, response, int(time.time())))
+        db.commit()
+
+def clear_cache():
+    with _cache_lock:
+        _mem_cache.clear()
+        db = _open_cache()
+        db.execute("DELETE FROM responses")
+        db.commit()
+    _decomp_cache.clear()
+    print(_("Gepetto's response cache was cleared."))
+
+# -----------------------------------------------------------------------------
+
+class ClearCacheHandler(idaapi.action_handler_t):
+    """
+    This handler empties the response cache, forcing subsequent queries to be
+    sent to the model again.
+    """
+    def __init__(self):
+        idaapi.action_handler_t.__init__(self)
+
+    def activate(self, ctx):
+        clear_cache()
+        return 1
+
+    # This action is always available.
+    def update(self, ctx):
+        return idaapi.AST_ENABLE_ALWAYS
+
+# =============================================================================
+# Batch API support
+# =============================================================================
+
+class GepettoBatchQueue:
+    """
+    Accumulates model queries and submits them in a single call to OpenAI's
+    Batch API. Batched queries are billed at half price and are not counted
+    against the per-minute rate limits, at the cost of a completion window of
+    up to 24 hours (in practice usually much less).
+    """
+    poll_interval = 60  # Seconds to wait between two status checks of a submitted batch.
+
+    def __init__(self):
+        self.requests = []
+        self.callbacks = {}
+        self.lock = threading.Lock()
+
+    def enqueue(self, query, cb):
+        """
+        Adds a query to the pending batch instead of sending it to the API.
+        :param query: The request which will eventually be sent to gpt-3.5-turbo
+        :param cb: The function to which the response will be passed to.
+        """
+        custom_id = str(uuid.uuid4())
+        with self.lock:
+            self.callbacks[custom_id] = cb
+            self.requests.append({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": "gpt-3.5-turbo",
+                    "messages": [{"role": "user", "content": query}]
+                },
+            })
+            pending = len(self.requests)
+        print(_("Query queued ({pending} pending). Submit them with Edit/Gepetto/Flush batch.")
+              .format(pending=pending))
+
+    def flush(self):
+        """
+        Submits all the pending queries as a single batch and starts a thread
+        polling for its completion.
+        """
+        with self.lock:
+            if not self.requests:
+                print(_("The batch queue is empty; nothing to submit."))
+                return
+            queued, callbacks = self.requests, self.callbacks
+            self.requests, self.callbacks = [], {}
+        t = threading.Thread(target=self._submit, args=[queued, callbacks])
+        t.start()
+
+    def _submit(self, queued, callbacks):
+        # The 0.x SDK predates the Batch API, so the /v1/files and /v1/batches
+        # endpoints are called directly over the pooled requests session.
+        openai = _load_openai()
+        headers = {"Authorization": "Bearer " + openai.api_key}
+        try:
+            jsonl = "\n".join(json.dumps(request) for request in queued)
+            upload = openai.requestssession.post(
+                openai.api_base + "/files",
+                headers=headers,
+                data={"purpose": "batch"},
+                files={"file": ("gepetto_batch.jsonl", io.BytesIO(jsonl.encode("utf-8")))})
+            upload.raise_for_status()
+            creation = openai.requestssession.post(
+                openai.api_base + "/batches",
+                headers=headers,
+                json={"input_file_id": upload.json()["id"],
+                      "endpoint": "/v1/chat/completions",
+                      "completion_window": "24h"})
+            creation.raise_for_status()
+        except Exception as e:
+            # Put the drained queries back so a failed submission doesn't lose them.
+            with self.lock:
+                self.requests.extend(queued)
+                self.callbacks.update(callbacks)
+            print(_("The batch could not be submitted (the queries were requeued): {error}")
+                  .format(error=str(e)))
+            return
+        print(_("Batch of {count} query(ies) submitted...").format(count=len(queued)))
+        try:
+            self._poll(creation.json()["id"], callbacks)
+        except Exception as e:
+            print(_("General exception encountered while running the query: {error}").format(error=str(e)))
+
+    def _poll(self, batch_id, callbacks):
+        openai = _load_openai()
+        headers = {"Authorization": "Bearer " + openai.api_key}
+        while True:
+            time.sleep(self.poll_interval)
+            status = openai.requestssession.get("{}/batches/{}".format(openai.api_base, batch_id),
+                                                headers=headers)
+            status.raise_for_status()
+            batch = status.json()
+            if batch["status"] == "completed":
+                break
+            if batch["status"] in ("failed", "expired", "cancelled"):
+                print(_("The batch could not be completed (status: {status}).").format(status=batch["status"]))
+                return
+
+        # Dispatch each response to the callback registered when it was queued.
+        output = openai.requestssession.get("{}/files/{}/content".format(openai.api_base, batch["output_file_id"]),
+                                            headers=headers)
+        output.raise_for_status()
+        for line in output.text.splitlines():
+            result = json.loads(line)
+            cb = callbacks.get(result["custom_id"])
+            if not cb:
+                continue
+            response = result["response"]["body"]["choices"][0]["message"]["content"]
+            ida_kernwin.execute_sync(lambda cb=cb, response=response: cb(response=response),
+                                     ida_kernwin.MFF_WRITE)
+
+batch_queue = GepettoBatchQueue()
+
+# -----------------------------------------------------------------------------
+
+class FlushBatchHandler(idaapi.action_handler_t):
+    """
+    This handler submits all the queries accumulated while batch mode is
+    enabled as a single Batch API request.
+    """
+    def __init__(self):
+        idaapi.action_handler_t.__init__(self)
+
+    def activate(self, ctx):
+        batch_queue.flush()
         return 1
 
     # This action is always available.
@@ -368,22 +772,129 @@ class RenameHandler(idaapi.action_handler_t):
 # gpt-3.5-turbo interaction
 # =============================================================================
 
-def query_model(query, cb, max_tokens=2500):
+class _RateLimiter:
     """
-    Function which sends a query to gpt-3.5-turbo and calls a callback when the response is available.
-    Blocks until the response is received
+    Token bucket keeping the request rate under the API's requests-per-minute
+    limit. Must only be used from the background event loop.
+    """
+    def __init__(self, requests_per_minute):
+        self.capacity = requests_per_minute
+        self.available = float(requests_per_minute)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+            self.updated = now
+            if self.available >= 1:
+                self.available -= 1
+                return
+            await asyncio.sleep((1 - self.available) * 60 / self.capacity)
+
+# All model queries run as coroutines on a single background event loop, so
+# concurrent invocations share the thread instead of each spawning their own.
+_loop = None
+_semaphore = None
+_rate_limiter = None
+
+def _start_loop():
+    """
+    Starts the background asyncio loop on which all the queries run.
+    Called lazily when the first query is sent; subsequent calls return the
+    existing loop.
+    """
+    global _loop
+    if _loop is not None:
+        return _loop
+    _loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def run():
+        global _semaphore, _rate_limiter
+        asyncio.set_event_loop(_loop)
+        _semaphore = asyncio.Semaphore(max_parallel_requests)
+        _rate_limiter = _RateLimiter(max_requests_per_minute)
+        ready.set()
+        _loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+
+    # Share one pooled aiohttp session for the event loop queries, so they
+    # reuse warm connections instead of paying a fresh TCP + TLS handshake
+    # each time.
+    openai = _load_openai()
+    openai.aiosession.set(asyncio.run_coroutine_threadsafe(_new_aiohttp_session(), _loop).result())
+    return _loop
+
+async def _new_aiohttp_session():
+    # aiohttp sessions must be created on the loop they will be used from.
+    import aiohttp
+    return aiohttp.ClientSession()
+
+# -----------------------------------------------------------------------------
+
+async def query_model(query, cb, max_tokens=2500, stream=False, retries=0, delay=0):
+    """
+    Coroutine which sends a query to gpt-3.5-turbo and calls a callback when the response is available.
+    At most max_parallel_requests queries are in flight at any time, and 429 errors
+    are retried with an exponential backoff.
     :param query: The request to send to gpt-3.5-turbo
     :param cb: Tu function to which the response will be passed to.
+    :param stream: Whether to feed partial responses to the callback as they
+        arrive, instead of a single call once the completion is done. Only safe
+        for callbacks which can handle an incomplete response (i.e. free text).
+    :param retries: The number of times the query was throttled by the API.
+    :param delay: Seconds to wait before sending the query, used to back off on retries.
     """
+    openai = _load_openai()
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "user", "content": query}
-            ]
-        )
-        ida_kernwin.execute_sync(functools.partial(cb, response=response.choices[0]["message"]["content"]),
-                                 ida_kernwin.MFF_WRITE)
+        if delay:
+            await asyncio.sleep(delay)
+        cached = _cache_get("gpt-3.5-turbo", query)
+        if cached is not None:
+            ida_kernwin.execute_sync(lambda: cb(response=cached), ida_kernwin.MFF_WRITE)
+            return
+        async with _semaphore:
+            await _rate_limiter.acquire()
+            response = await openai.ChatCompletion.acreate(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "user", "content": query}
+                ],
+                stream=stream
+            )
+            if stream:
+                # Show the first tokens as soon as they arrive instead of
+                # making the user wait for the full completion. Partial
+                # dispatches are marked as such and throttled to one per
+                # second to keep the database writes down.
+                chunks = []
+                last_update = time.monotonic()
+                async for chunk in response:
+                    delta = chunk.choices[0]["delta"].get("content", "")
+                    if not delta:
+                        continue
+                    chunks.append(delta)
+                    now = time.monotonic()
+                    if now - last_update >= 1:
+                        last_update = now
+                        ida_kernwin.execute_sync(
+                            lambda partial_content="".join(chunks): cb(response=partial_content, final=False),
+                            ida_kernwin.MFF_WRITE)
+                content = "".join(chunks)
+            else:
+                content = response.choices[0]["message"]["content"]
+        _cache_put("gpt-3.5-turbo", query, content)
+        ida_kernwin.execute_sync(lambda: cb(response=content), ida_kernwin.MFF_WRITE)
+    except openai.error.RateLimitError as e:
+        if retries >= 5:
+            print(_("gpt-3.5-turbo could not complete the request: {error}").format(error=str(e)))
+            return
+        # Back off exponentially and requeue the query.
+        await asyncio.sleep(2 ** retries)
+        await query_model(query, cb, max_tokens, stream, retries + 1)
     except openai.InvalidRequestError as e:
         # Context length exceeded. Determine the max number of tokens we can ask for and retry.
         m = re.search(r'maximum context length is (\d+) tokens, however you requested \d+ tokens \((\d+) in your '
@@ -396,7 +907,7 @@ def query_model(query, cb, max_tokens=2500):
         if max_tokens >= 750:
             print(_("Context length exceeded! Reducing the completion tokens to "
                     "{max_tokens}...").format(max_tokens=max_tokens))
-            query_model(query, cb, max_tokens)
+            await query_model(query, cb, max_tokens, stream)
         else:
             print("Unfortunately, this function is too big to be analyzed with the model's current API limits.")
 
@@ -407,24 +918,29 @@ def query_model(query, cb, max_tokens=2500):
 
 # -----------------------------------------------------------------------------
 
-def query_model_async(query, cb):
+def query_model_async(query, cb, stream=False, delay=0):
     """
     Function which sends a query to gpt-3.5-turbo and calls a callback when the response is available.
     :param query: The request to send to gpt-3.5-turbo
     :param cb: Tu function to which the response will be passed to.
+    :param stream: Whether to feed partial responses to the callback as they arrive.
+    :param delay: Seconds to wait before sending the query, used to back off on retries.
     """
+    if batch_mode:
+        batch_queue.enqueue(query, cb)
+        return
     print(_("Request to gpt-3.5-turbo sent..."))
-    t = threading.Thread(target=query_model, args=[query, cb])
-    t.start()
+    asyncio.run_coroutine_threadsafe(query_model(query, cb, stream=stream, delay=delay), _start_loop())
 
 # =============================================================================
 # Main
 # =============================================================================
 
 def PLUGIN_ENTRY():
-    if not openai.api_key:
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        if not openai.api_key:
+    global api_key
+    if not api_key:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
             print(_("Please edit this script to insert your OpenAI API key!"))
             raise ValueError("No valid OpenAI API key found")
 